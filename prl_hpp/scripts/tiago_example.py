@@ -10,7 +10,7 @@ robot, commander_left, commander_right, planner = planner()
 commander_right.start_trajectory()
 
 q_curr = robot.get_meas_q()
-planner.v(q_curr)
+planner.v(q_curr.tolist()) # hpp (CORBA) expects a list
 
 planner.lock_left_arm()
 planner.lock_head()
@@ -1,22 +1,46 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
 from hpp.corbaserver.manipulation import ProblemSolver, Rule, Constraints, ConstraintGraph, ConstraintGraphFactory, Client, SecurityMargins
 from hpp.gepetto.manipulation import ViewerFactory
 from hpp.gepetto import PathPlayer
 from hpp.corbaserver import loadServerPlugin
 from hpp_idl.hpp import Error as HppError
 
-from prl_pinocchio.tools.utils import compare_configurations, compare_poses, euler_to_quaternion
+from prl_pinocchio.tools.utils import compare_configurations, compare_poses_array, euler_to_quaternion
 from prl_hpp.tools.utils import wd
 from prl_hpp.tools.instate_planner import InStatePlanner
 
 from prl_hpp.tools.hpp_robots import HppRobot, TargetRobotStrings, SupportRobotStrings
 
-try:
-    loadServerPlugin ("corbaserver", "manipulation-corba.so")
-except:
-    import os
-    loadServerPlugin ("corbaserver", os.environ.get('CONDA_PREFIX')+"/lib/hppPlugins/manipulation-corba.so")
+_hpp_ready = False
+
+def _ensure_hpp_ready():
+    """
+    Load the manipulation plugin in the hpp server and reset its problem (only once, the first time a Planner is created).
+    """
+    global _hpp_ready
+    if _hpp_ready:
+        return
+
+    try:
+        loadServerPlugin ("corbaserver", "manipulation-corba.so")
+    except:
+        import os
+        loadServerPlugin ("corbaserver", os.environ.get('CONDA_PREFIX')+"/lib/hppPlugins/manipulation-corba.so")
+
+    Client ().problem.resetProblem ()
+    _hpp_ready = True
 
-Client ().problem.resetProblem ()
+@functools.lru_cache(maxsize=256)
+def _orientation_to_quaternion(orientation):
+    """
+    Memoized conversion of an orientation (euler angles or quaternion, as a tuple) into a quaternion tuple.
+    """
+    if(len(orientation) == 3):
+        return tuple(euler_to_quaternion(orientation))
+    return orientation
 
 class Path:
     def __init__(self, id, corbaPath, jointList, targetFrames = []):
@@ -36,6 +60,8 @@ class Planner:
         ----------
             robot (Robot): Associated Robot class. (see robot.py)
         """
+        _ensure_hpp_ready()
+
         self.robot = robot
         self.hpp_robot = HppRobot(robot.pin_robot_wrapper.model.name, "robot", robot.get_urdf_explicit(), robot.get_srdf_explicit())
 
@@ -70,6 +96,23 @@ class Planner:
         # User defined locked joint constraint (re-used for every graph)
         self.lockJointConstraints = []
 
+        # Constraint graphs structures already validated (see _create_simple_cg)
+        self._validated_graphs = set()
+
+        # Current constraint graph, and its structure, re-used by the next plan if it is the same (see _create_simple_cg)
+        self._last_cg = None
+        self._last_cg_key = None
+
+        # In-state planner of make_gripper_approach, re-used by the next plan if possible
+        self._instatePlanner = None
+        self._instatePlanner_key = (None, None)
+
+        # Current placement of the supports (see _set_support_pose)
+        self._support_poses = {}
+
+        # Goal configurations sampling
+        self.num_goal_samples = 10 # Stop sampling goal configurations once this number is reached (None to always run every trials)
+
     def set_planning_timeout(self, timeout, stopWhenProblemIsSolved = True):
         """
         Set the maximum duration the planner has to find a solution.
@@ -117,18 +160,19 @@ class Planner:
             constraintNames (str[]): name of created constraints.
         """
         # Generate constraints name
-        if constraintNames == None:
+        if constraintNames is None:
             constraintNames = ["locked_" + jointName for jointName in jointNames]
 
         # get locked joint values from current configuration
-        if jointValues == None:
-            all_names = self.robot.get_joint_names()
+        if jointValues is None:
+            model = self.robot.pin_robot_wrapper.model
+            name_to_idx = {name: idx for idx, name in enumerate(model.names)}
             q_current = self.robot.get_meas_q()
             jointValues = []
             for j_name in jointNames:
-                j_index = list(self.robot.pin_robot_wrapper.model.names).index(j_name)
-                j_idx_q = self.robot.pin_robot_wrapper.model.joints[j_index].idx_q
-                j_nq = self.robot.pin_robot_wrapper.model.joints[j_index].nq
+                j_index = name_to_idx[j_name]
+                j_idx_q = model.joints[j_index].idx_q
+                j_nq = model.joints[j_index].nq
                 jointValues.extend(q_current[j_idx_q:j_idx_q+j_nq])
 
         # Create the constraints
@@ -136,6 +180,7 @@ class Planner:
             self.ps.createLockedJoint(constraintNames[i], "robot/" + jointNames[i], [jointValues[i]])
 
         self.ps.addLockedJointConstraints(lockName, constraintNames)
+        self._last_cg_key = None # The locked values may have changed, the graph has to be re-created
 
         self.lockJointConstraints.extend(constraintNames)
         return constraintNames
@@ -165,17 +210,16 @@ class Planner:
             AssertionError: If no valid goal configuration can be found.
             AssertionError: If validate is True and the graph is not found valid.
         """
-        if q_start == None:
+        if q_start is None:
             q_start = self.robot.get_meas_q()
 
         pose[1] = self._convert_orientation(pose[1])
 
-        self._reset_problem()
         gripperFullname = "robot/" + gripperName
         gripperLink = self.robot.get_gripper_link(gripperName)
 
         # The configuration space is now bigger because of the configuration of the target
-        q_start = self._merge_q(q_start, q_target = (pose[0]+pose[1]) )
+        q_start = self._merge_q(q_start, q_target = (list(pose[0]) + pose[1]) )
 
         # Create the ConstraintGraph
         cg = self._create_simple_cg([gripperFullname], ['target'], [['target/handle']], validate, replace_target_constraints=True)
@@ -188,8 +232,7 @@ class Planner:
         self.v(q_init)
 
         # Generate pair goal configuration (pre-graps, grasp)
-        q_goals = []
-        for _ in range(1000 // (5 if check_feasibility_only else 1)): # Generate less goal pose when checking for feasibility
+        def sample_goal():
             q = self.hpp_robot.shootRandomConfig()
             res_pre, q_pre, error_pre = cg.generateTargetConfig(gripperFullname + ' > target/handle | f_01', q_init, q)
             res_grasp, q_grasp, error_grasp = cg.generateTargetConfig(gripperFullname + ' > target/handle | f_12', q_pre, q_pre)
@@ -198,9 +241,12 @@ class Planner:
                 self.ps.erasePath(pathId) # Erase the path as it's not needed anymore
                 collide, _ = self.robot.compute_collisions(self._split_q(q_grasp, 'robot'), stop_at_first_collision=True) # if the path is of length 0, the collision wouldn't be checked
                 if not collide and res_path:
-                    q_goals.append([q_pre, q_grasp])
-                    if check_feasibility_only: # No need to generate multiple goal poses when checking for feasibility
-                        break
+                    return [q_pre, q_grasp]
+            return None
+
+        q_goals = self._sample_goal_configs(sample_goal,
+                                            1000 // (5 if check_feasibility_only else 1), # Generate less goal pose when checking for feasibility
+                                            1 if check_feasibility_only else self.num_goal_samples) # No need to generate multiple goal poses when checking for feasibility
 
         assert len(q_goals) > 0, "No goal configuration found"
 
@@ -209,13 +255,18 @@ class Planner:
             return
 
         # Prepare solving in-state
-        instatePlanner = InStatePlanner (self.ps)
-        instatePlanner.setEdge(cg, "Loop | f")
-        instatePlanner.optimizerTypes = [ "RandomShortcut" ]
+        # The in-state planner (its problem and edge setup) is kept between plans as long as the graph and the supports placements are the same
+        instatePlanner_key = (cg, tuple(sorted(self._support_poses.items())))
+        if self._instatePlanner is None or self._instatePlanner_key != instatePlanner_key:
+            self._instatePlanner = InStatePlanner (self.ps)
+            self._instatePlanner.setEdge(cg, "Loop | f")
+            self._instatePlanner.optimizerTypes = [ "RandomShortcut" ]
+            self._instatePlanner_key = instatePlanner_key
+        instatePlanner = self._instatePlanner
         instatePlanner.timeOutPathPlanning = self.ps.getTimeOutPathPlanning()
         instatePlanner.stopWhenProblemIsSolved = self.stopWhenProblemIsSolved
 
-        # Solve the problem
+        # Solve the problem (BiRRT* is a single query planner : it needs an empty roadmap)
         path = instatePlanner.computePath(q_init, [q_pre for q_pre, q_grasp in q_goals], resetRoadmap=True)
 
         # Add path to the problem
@@ -228,7 +279,7 @@ class Planner:
             if(compare_configurations(self.robot.pin_robot_wrapper.model, self._split_q(q_pre, 'robot'), self._split_q(q_end, 'robot'))):
                 q_end_grasp = q_grasp
                 break
-        assert q_end_grasp != None, "Error while concatenating the last part of the path."
+        assert q_end_grasp is not None, "Error while concatenating the last part of the path."
 
         # Add the pre-grasp to grap path
         wps = self.ps.getWaypoints(pathId)[0]
@@ -291,20 +342,19 @@ class Planner:
             AssertionError: If the end configuration is not valid.
             AssertionError: If validate is True and the graph is not found valid.
         """
-        if q_start == None:
+        if q_start is None:
             q_start = self.robot.get_meas_q()
-        if q_end == None:
-            q_end = q_start[:]
+        if q_end is None:
+            q_end = list(q_start)
 
         # Convert euler rotations into quaternions (if needed)
         pose_pick[1]  = self._convert_orientation(pose_pick[1])
         pose_place[1] = self._convert_orientation(pose_place[1])
 
         # Merge postion and orientation in one list
-        pose_pick = pose_pick[0] + pose_pick[1]
-        pose_place = pose_place[0] + pose_place[1]
+        pose_pick = list(pose_pick[0]) + pose_pick[1]
+        pose_place = list(pose_place[0]) + pose_place[1]
 
-        self._reset_problem()
         gripperFullname = "robot/" + gripperName
         gripperLink = self.robot.get_gripper_link(gripperName)
 
@@ -324,11 +374,12 @@ class Planner:
         ]
 
         # Place supports at pick and place locations
-        self.hpp_robot.setJointPosition('support_pick/root_joint', pose_pick)
-        self.hpp_robot.setJointPosition('support_place/root_joint', pose_place)
+        self._set_support_pose('support_pick', pose_pick)
+        self._set_support_pose('support_place', pose_place)
 
-        # Create the ConstraintGraph
-        cg = self._create_simple_cg([gripperFullname, "support_pick/gripper", "support_place/gripper"], ['target', "support_pick", "support_place"], [['target/handle', 'target/handle_bottom'], [], []], validate, rules = rules)
+        # Create the ConstraintGraph (the supports grasps constraints depend on their placements, so they are part of the graph key)
+        cg = self._create_simple_cg([gripperFullname, "support_pick/gripper", "support_place/gripper"], ['target', "support_pick", "support_place"], [['target/handle', 'target/handle_bottom'], [], []], validate, rules = rules,
+                                    key_extra = (tuple(pose_pick), tuple(pose_place)))
 
         # Project the initial configuration in the initial node
         res_init, q_init, _ = cg.applyNodeConstraints("support_pick/gripper grasps target/handle_bottom", q_start)
@@ -367,12 +418,9 @@ class Planner:
 
         # Split the path
         wps = self.ps.getWaypoints(pathId)[0]
-        pick_index = None
-        for i, q in enumerate(wps):
-            target_pose = self._split_q(q, 'target')
-            if(not compare_poses(target_pose, pose_pick)):
-                pick_index = i
-                break
+        target_poses = [self._split_q(q, 'target') for q in wps]
+        moved_indexes = np.flatnonzero(~compare_poses_array(target_poses, pose_pick))
+        pick_index = int(moved_indexes[0]) if len(moved_indexes) else None
 
         # Create sub path
         pick_pathId = self._create_path(wps[:pick_index])
@@ -385,7 +433,7 @@ class Planner:
             if(compare_configurations(self.robot.pin_robot_wrapper.model, self._split_q(q_place, 'robot'), self._split_q(q_end, 'robot'))):
                 q_end_clear = q_clear
                 break
-        assert q_end_clear != None, "Error while concatenating the last part of the path."
+        assert q_end_clear is not None, "Error while concatenating the last part of the path."
 
         # Create the homing path
         home_pathId = self._create_path([q_end, q_end_clear])
@@ -395,10 +443,10 @@ class Planner:
         param_place_pathId = self._timeParametrizePath(place_pathId)
         param_home_pathId = self._timeParametrizePath(home_pathId)
 
-        # Extract paths
-        param_pick_path = wd(self.ps.hppcorba.problem.getPath(param_pick_pathId))
-        param_place_path = wd(self.ps.hppcorba.problem.getPath(param_place_pathId))
-        param_home_path = wd(self.ps.hppcorba.problem.getPath(param_home_pathId))
+        # Extract paths (independent requests, sent concurrently to the hpp server)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            param_pick_path, param_place_path, param_home_path = executor.map(lambda pathId: wd(self.ps.hppcorba.problem.getPath(pathId)),
+                                                                              [param_pick_pathId, param_place_pathId, param_home_pathId])
 
         # return paths
         return  Path(param_pick_pathId, param_pick_path, self.robot.get_joint_names(), [gripperLink]), \
@@ -415,15 +463,15 @@ class Planner:
 
         # Position pick and place markers if necessary
         if(pose_pick is not None):
-            self.hpp_robot.setJointPosition('support_pick/root_joint', pose_pick)
+            self._set_support_pose('support_pick', pose_pick)
         if(pose_place is not None):
-            self.hpp_robot.setJointPosition('support_place/root_joint', pose_place)
+            self._set_support_pose('support_place', pose_place)
 
         # Display robot and target
         self.v(self._merge_q(q_robot, pose_target))
 
     def _merge_q(self, q_robot, q_target = [0,0,0, 0,0,0,1]):
-        return (q_robot + q_target)
+        return (list(q_robot) + list(q_target))
 
     def _split_q(self, q, part=''):
         split = {'robot': q[:-7], 'target': q[-7:]}
@@ -452,7 +500,15 @@ class Planner:
         self.v = self.vf.createViewer()
         self.pp = PathPlayer(self.v)
 
+    def _set_support_pose(self, supportName, pose):
+        """
+        Move the support, and keep track of its placement (the in-state planner has to be re-created when it changes)
+        """
+        self.hpp_robot.setJointPosition(supportName + '/root_joint', pose)
+        self._support_poses[supportName] = tuple(pose)
+
     def _reset_problem(self):
+        self._last_cg, self._last_cg_key = None, None
         try:
             self.graph.deleteGraph('graph')
         except HppError:
@@ -473,13 +529,12 @@ class Planner:
         self.ps.optimizePath(pathId)
         return self.ps.numberPaths() -1
 
-    def _convert_orientation(self, orientation):
+    @staticmethod
+    def _convert_orientation(orientation):
         """
         Return the orientation as quaternions
         """
-        if(len(orientation) == 3):
-            return euler_to_quaternion(orientation)
-        return orientation
+        return list(_orientation_to_quaternion(tuple(orientation)))
 
     def _create_path(self, waypoints):
         # Ensure that there are no null length segments in the path (to prevent latter hpp bug during time parametrization)
@@ -497,11 +552,27 @@ class Planner:
             self.ps.appendDirectPath(pathId, q, False)
         return pathId
 
-    def _create_simple_cg(self, grippers, objects, objects_handles, validate, replace_target_constraints = False, rules = None):
+    def _create_simple_cg(self, grippers, objects, objects_handles, validate, replace_target_constraints = False, rules = None, key_extra = ()):
         # Rules
         if(rules is None):
             rules = [ Rule([".*"], [".*"], True), ]
 
+        # key_extra holds what else the graph constraints depend on (e.g. the support placements captured by the grasps constraints)
+        graph_key = (tuple(grippers), tuple(objects), tuple(map(tuple, objects_handles)), replace_target_constraints,
+                     tuple((tuple(r.grippers), tuple(r.handles), r.link) for r in rules),
+                     tuple(self.lockJointConstraints), self._collision_margin, tuple(map(tuple, self._collision_margin_exclusion)),
+                     tuple(key_extra))
+
+        # Re-use the current graph if it has the same structure (only clear the problem from the previous plan)
+        if(graph_key == self._last_cg_key):
+            self.ps.clearRoadmap()
+            self.ps.resetGoalConfigs()
+            if(validate):
+                self._validate_cg(graph_key)
+            return self._last_cg
+
+        self._reset_problem()
+
         # Create graph using ConstraintGraphFactory
         cg = ConstraintGraph (self.hpp_robot, 'graph')
         factory = ConstraintGraphFactory (cg)
@@ -543,13 +614,50 @@ class Planner:
 
         # Validate constraint graph
         if(validate):
-            cgraph = cproblem.getConstraintGraph()
-            cgraph.initialize()
-            graphValidation = wd(self.ps.client.manipulation.problem.createGraphValidation())
-            assert graphValidation.validate(cgraph), graphValidation.str()
+            self._validate_cg(graph_key)
 
+        self._last_cg, self._last_cg_key = cg, graph_key
         return cg
 
+    def _validate_cg(self, graph_key):
+        """
+        Validate the current constraint graph (skipped if a graph with the same structure has already been validated)
+        """
+        if(graph_key in self._validated_graphs):
+            return
+        cproblem = wd(self.ps.client.basic.problem.getProblem())
+        cgraph = cproblem.getConstraintGraph()
+        cgraph.initialize()
+        graphValidation = wd(self.ps.client.manipulation.problem.createGraphValidation())
+        assert graphValidation.validate(cgraph), graphValidation.str()
+        self._validated_graphs.add(graph_key)
+
+    def _sample_goal_configs(self, sample_goal, trials, max_goals = None):
+        """
+        Run goal configuration sampling trials (sequentially, as they all use the projectors of the same graph on the hpp server).
+
+        Parameters
+        ----------
+            sample_goal (callable): Function running one trial, returning a goal or None if the trial failed.
+            trials (int): Number of trials to run.
+
+        Optionnals parameters:
+        ----------------------
+            max_goals (int): Stop sampling as soon as this number of goals is found. (If unspecified, all the trials are run.)
+
+        Returns
+        -------
+            goals (list): The goals found, in the order of the trials.
+        """
+        goals = []
+        for _ in range(trials):
+            goal = sample_goal()
+            if goal is not None:
+                goals.append(goal)
+                if max_goals is not None and len(goals) >= max_goals:
+                    break
+        return goals
+
     def _safe_solve(self):
         """
         Solve the problem and catch timeout exception
@@ -22,9 +22,20 @@ class Robot:
         # Build pinocchio models and wrappers
         pin_model = pinocchio.buildModelFromXML(urdfString)
         pin_collision_model = pinocchio.buildGeomFromUrdfString(pin_model, self.get_urdf_explicit(), pinocchio.COLLISION)
-        pin_visual_model    = pinocchio.buildGeomFromUrdfString(pin_model, self.get_urdf_explicit(), pinocchio.VISUAL)
 
-        self.pin_robot_wrapper = pinocchio.RobotWrapper(pin_model, pin_collision_model, pin_visual_model)
+        # The visual model is only loaded when a visualizer is created (see create_visualizer)
+        self.pin_robot_wrapper = pinocchio.RobotWrapper(pin_model, pin_collision_model, None)
+
+        # Names of the joints (never change for a given model)
+        self._joint_names = list(pin_model.names[1:])
+
+        # Joints bounds (used to adjust the measured configurations)
+        self._lower_position_limit = numpy.asarray(pin_model.lowerPositionLimit)
+        self._upper_position_limit = numpy.asarray(pin_model.upperPositionLimit)
+
+        # Cache of joints and frames ids (to avoid looking them up by name at each call)
+        self._joint_id_cache = {}
+        self._frame_id_cache = {}
 
         # Prepare collisions
         self._init_collisions()
@@ -91,7 +102,7 @@ class Robot:
 
         Returns
         -------
-            q (float[]): the configuration.
+            q (numpy.ndarray): the configuration.
 
         Raises
         ------
@@ -112,9 +123,9 @@ class Robot:
 
         Returns
         -------
-            q (float[]): the configuration.
-            v (float[]): the velocities.
-            tau (float[]): the efforts.
+            q (numpy.ndarray): the configuration.
+            v (numpy.ndarray): the velocities.
+            tau (numpy.ndarray): the efforts.
 
         Raises
         ------
@@ -123,11 +134,12 @@ class Robot:
         t, q, v, tau = self._get_raw_meas_qvtau()
 
         if not raw:
-            for i, pos in enumerate(q):
-                pos = max(pos, self.pin_robot_wrapper.model.lowerPositionLimit[i])
-                pos = min(pos, self.pin_robot_wrapper.model.upperPositionLimit[i])
-                assert abs(pos - q[i]) < 1e-3 , "Joint [" + str(i) + "] " + self.pin_robot_wrapper.model.names[i+1] + " way out of bounds : " + str(pos) + " not in [" + str(self.pin_robot_wrapper.model.lowerPositionLimit[i]) + ", " + str(self.pin_robot_wrapper.model.upperPositionLimit[i]) + "]"
-                q[i] = pos
+            q = numpy.asarray(q)
+            q_clipped = numpy.clip(q, self._lower_position_limit, self._upper_position_limit)
+            deviation = numpy.abs(q_clipped - q)
+            i = int(numpy.argmax(deviation)) # Joint deviating the most from its bounds
+            assert deviation[i] < 1e-3 , "Joint [" + str(i) + "] " + self.pin_robot_wrapper.model.names[i+1] + " way out of bounds : " + str(q[i]) + " not in [" + str(self._lower_position_limit[i]) + ", " + str(self._upper_position_limit[i]) + "]"
+            q = q_clipped
 
         return t, q, v, tau
 
@@ -139,9 +151,9 @@ class Robot:
 
         Returns
         -------
-            q (float[]): the configuration (pinocchio joint order).
-            v (float[]): the velocities (pinocchio joint order).
-            tau (float[]): the efforts (pinocchio joint order).
+            q (numpy.ndarray): the configuration (pinocchio joint order).
+            v (numpy.ndarray): the velocities (pinocchio joint order).
+            tau (numpy.ndarray): the efforts (pinocchio joint order).
 
         Raises
         ------
@@ -171,17 +183,45 @@ class Robot:
         ------
             AssertionError: If jointName is not in the robot model.
         """
-        if(q==None):
+        return self.get_joint_poses([jointName], q)[jointName]
+
+    def get_joint_poses(self, jointNames, q=None):
+        """
+        Get the current 6D poses of multiple joints.
+
+        Compute the forward kinematic from the configuration only once for all the joints.
+
+        Parameters:
+        ----------------------
+            jointNames (str[]): Names of the joints to read the pose of.
+
+        Optionnals parameters:
+        ----------------------
+            q (float[]): Configuration of the robot. If None, the current configuration will be read from 'joint_state_topic'.
+
+        Returns
+        -------
+            xyz_quats (dict): position and orientation (as a quaternion) coordinates concatenanted, for each joint name.
+
+        Raises
+        ------
+            AssertionError: If one of the jointNames is not in the robot model.
+        """
+        if(q is None):
             q = self.get_meas_q()
 
-        q = numpy.matrix(q).T
+        q = numpy.ascontiguousarray(q, dtype=numpy.float64)
 
-        frame_index = self.pin_robot_wrapper.model.getJointId(jointName)
-        assert frame_index < len(self.pin_robot_wrapper.data.oMi), "Joint name not found in robot model : " + jointName
+        joint_indexes = {}
+        for jointName in jointNames:
+            joint_index = self._joint_id_cache.get(jointName)
+            if joint_index is None:
+                joint_index = self._joint_id_cache[jointName] = self.pin_robot_wrapper.model.getJointId(jointName)
+            assert joint_index < len(self.pin_robot_wrapper.data.oMi), "Joint name not found in robot model : " + jointName
+            joint_indexes[jointName] = joint_index
 
-        oMi = self.pin_robot_wrapper.placement(q, frame_index)
-        xyz_quat = pinocchio.SE3ToXYZQUATtuple(oMi)
-        return xyz_quat
+        self.pin_robot_wrapper.forwardKinematics(q)
+        return {jointName: pinocchio.SE3ToXYZQUATtuple(self.pin_robot_wrapper.data.oMi[joint_index]) for jointName, joint_index in joint_indexes.items()}
 
     def get_frame_pose(self, frameName, q=None):
         """
@@ -205,12 +245,14 @@ class Robot:
         ------
             AssertionError: If frameName is not in the robot model.
         """
-        if(q==None):
+        if(q is None):
             q = self.get_meas_q()
 
-        q = numpy.matrix(q).T
+        q = numpy.ascontiguousarray(q, dtype=numpy.float64)
 
-        frame_index = self.pin_robot_wrapper.model.getFrameId(frameName)
+        frame_index = self._frame_id_cache.get(frameName)
+        if frame_index is None:
+            frame_index = self._frame_id_cache[frameName] = self.pin_robot_wrapper.model.getFrameId(frameName)
         assert frame_index < len(self.pin_robot_wrapper.data.oMf), "Frame name not found in robot model : " + frameName
 
         oMf = self.pin_robot_wrapper.framePlacement(q, frame_index)
@@ -240,7 +282,7 @@ class Robot:
         -------
             jointNames (str[]): List of the names
         """
-        return list(self.pin_robot_wrapper.model.names[1:])
+        return self._joint_names
 
     def is_at_config(self, q, threshold=0.1):
         """
@@ -268,6 +310,11 @@ class Robot:
         return compare_configurations(self.pin_robot_wrapper.model, q, q_curr, threshold)
 
     def create_visualizer(self):
+        # Load the visual model (meshes) on first use only
+        if self.pin_robot_wrapper.visual_model is None:
+            self.pin_robot_wrapper.visual_model = pinocchio.buildGeomFromUrdfString(self.pin_robot_wrapper.model, self.get_urdf_explicit(), pinocchio.VISUAL)
+            self.pin_robot_wrapper.visual_data = pinocchio.GeometryData(self.pin_robot_wrapper.visual_model)
+
         # from pinocchio.visualize import RVizVisualizer
         # self.pin_robot_wrapper.setVisualizer(RVizVisualizer())
         # self.pin_robot_wrapper.initViewer(loadModel=True, initRosNode=False)
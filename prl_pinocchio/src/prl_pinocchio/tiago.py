@@ -42,9 +42,9 @@ class Tiago_Robot(Robot):
 
         Returns
         -------
-            q (float[]): the configuration.
-            v (float[]): the velocities.
-            tau (float[]): the efforts.
+            q (numpy.ndarray): the configuration.
+            v (numpy.ndarray): the velocities.
+            tau (numpy.ndarray): the efforts.
 
         Raises
         ------
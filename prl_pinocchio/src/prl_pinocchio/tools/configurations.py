@@ -1,18 +1,20 @@
 import pinocchio as pin
+import numpy as np
 import rospy
 
 class ConfigurationConvertor:
     def __init__(self, pin_model, ros_joint):
-        self.q_pin_neutral = list(pin.neutral(pin_model))
-        self.v_pin_neutral = [0] * pin_model.nv
+        self.q_pin_neutral = np.array(pin.neutral(pin_model))
+        self.v_pin_neutral = np.zeros(pin_model.nv)
 
         # Init variables for conversion
         self._idx_q_pin_to_ros = [-1] * len(self.q_pin_neutral) # For each component of q (for pin) give the associated idx in q (for ros). -1 means no measure associated, take from neutral q.
         self._idx_v_pin_to_ros = [-1] * len(self.v_pin_neutral) # idem
         self._idx_q_ros_to_pin = [-1] * len(ros_joint)
         self._idx_v_ros_to_pin = [-1] * len(ros_joint)
+        pin_name_to_idx = {name: idx for idx, name in enumerate(pin_model.names)}
         for ros_idx, joint_name in enumerate(ros_joint):
-            pin_index = pin_model.names.tolist().index(joint_name)
+            pin_index = pin_name_to_idx[joint_name]
             pin_nq = pin_model.joints[pin_index].nq
             pin_nv = pin_model.joints[pin_index].nv
             if pin_nq == 1:
@@ -24,37 +26,43 @@ class ConfigurationConvertor:
                 self._idx_v_pin_to_ros[pin_idxv] = ros_idx
                 self._idx_v_ros_to_pin[ros_idx] = pin_idxv
 
+        # Store the lookup tables as index arrays to rearrange configurations with numpy fancy indexing
+        self._idx_q_pin_to_ros = np.asarray(self._idx_q_pin_to_ros, dtype=np.intp)
+        self._idx_v_pin_to_ros = np.asarray(self._idx_v_pin_to_ros, dtype=np.intp)
+        self._idx_q_ros_to_pin = np.asarray(self._idx_q_ros_to_pin, dtype=np.intp)
+        self._idx_v_ros_to_pin = np.asarray(self._idx_v_ros_to_pin, dtype=np.intp)
+        self._q_pin_mask = self._idx_q_pin_to_ros != -1
+        self._v_pin_mask = self._idx_v_pin_to_ros != -1
+        self._idx_q_measured = self._idx_q_pin_to_ros[self._q_pin_mask] # ros idx of every pin component that has a measure
+        self._idx_v_measured = self._idx_v_pin_to_ros[self._v_pin_mask] # idem
+
     def q_pin_to_ros(self, q_pin):
-        q_res = []
-        for pin_idxq in self._idx_q_ros_to_pin:
-            assert pin_idxq != -1, "Cannot convert configuration : not all ros joint can be found in pin model"
-            q_res.append(q_pin[pin_idxq])
-        return q_res
+        return self._pin_to_ros(q_pin, self._idx_q_ros_to_pin)
 
     def q_ros_to_pin(self, q_ros):
-        q_res = self.q_pin_neutral[:]
-        for pin_idxq, ros_idxq in enumerate(self._idx_q_pin_to_ros):
-            if(ros_idxq != -1):
-                q_res[pin_idxq] = q_ros[ros_idxq]
-        return q_res
+        return self._ros_to_pin(q_ros, self.q_pin_neutral, self._q_pin_mask, self._idx_q_measured)
 
     def v_pin_to_ros(self, v_pin):
-        v_res = []
-        for pin_idxv in self._idx_v_ros_to_pin:
-            assert pin_idxv != -1, "Cannot convert configuration : not all ros joint can be found in pin model"
-            v_res.append(v_pin[pin_idxv])
-        return v_res
+        return self._pin_to_ros(v_pin, self._idx_v_ros_to_pin)
 
     def v_ros_to_pin(self, v_ros):
-        v_res = self.v_pin_neutral[:]
-        for pin_idxv, ros_idxv in enumerate(self._idx_v_pin_to_ros):
-            if(ros_idxv != -1):
-                v_res[pin_idxv] = v_ros[ros_idxv]
-        return v_res
+        return self._ros_to_pin(v_ros, self.v_pin_neutral, self._v_pin_mask, self._idx_v_measured)
+
+    def _pin_to_ros(self, x_pin, idx_ros_to_pin):
+        assert not np.any(idx_ros_to_pin == -1), "Cannot convert configuration : not all ros joint can be found in pin model"
+        return np.asarray(x_pin)[idx_ros_to_pin]
+
+    def _ros_to_pin(self, x_ros, x_pin_neutral, pin_mask, idx_measured):
+        x_ros = np.asarray(x_ros, dtype=np.float64)
+        if len(idx_measured) == len(x_pin_neutral): # Every component is measured : gather directly in a new array
+            return np.take(x_ros, idx_measured)
+        x_res = x_pin_neutral.copy()
+        x_res[pin_mask] = np.take(x_ros, idx_measured)
+        return x_res
 
     ''' Return a vector of size nv, with True for pin joint corresponding to a ros joint, and False else where'''
     def v_pin_mask(self):
-        return [False if idx == -1 else True for idx in self._idx_v_pin_to_ros]
+        return self._v_pin_mask.tolist()
 
     def debug_print(self):
         print("q:")
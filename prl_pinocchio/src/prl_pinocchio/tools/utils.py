@@ -57,6 +57,35 @@ def compare_poses(pose_1, pose_2, threshold = 0.001):
 
     return np.linalg.norm([np.linalg.norm(vw.angular), np.linalg.norm(vw.linear)]) < threshold
 
+def compare_poses_array(poses, pose, threshold = 0.001):
+    """
+    Check, for multiple poses at once, wether they are close enough to a reference pose.
+
+    Vectorized version of compare_poses (for quaternion orientations only). The SE3 distance is approximated by the
+    norm of the translation and rotation angle errors, which matches compare_poses for distances around the threshold.
+
+    Parameters
+    ----------
+        poses (float[N][7]): Positions and orientations (quaternion) of the poses to compare.
+        pose (float[7]): Position and orientation (quaternion) of the reference pose.
+
+    Optionnals parameters:
+    ----------------------
+        threshold (foat): Error tolerance.
+
+    Returns
+    -------
+        isEqual (bool[N]): True for each pose that is close enough to the reference one.
+    """
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    pose = np.asarray(pose, dtype=np.float64)
+
+    trans_err = np.linalg.norm(poses[:, :3] - pose[:3], axis=1)
+    quat_dot = np.abs(poses[:, 3:] @ pose[3:]) / (np.linalg.norm(poses[:, 3:], axis=1) * np.linalg.norm(pose[3:]))
+    rot_err = 2. * np.arccos(np.minimum(quat_dot, 1.))
+
+    return np.hypot(trans_err, rot_err) < threshold
+
 def euler_to_quaternion(euler):
     """
     Convert euler angles to quaternion.
@@ -9,7 +9,7 @@ from prl_tsid.commander import PathFollower
 robot, commander_left, commander_right, planner = planner()
 
 q_curr = robot.get_meas_q()
-planner.v(q_curr)
+planner.v(q_curr.tolist()) # hpp (CORBA) expects a list
 planner.lock_left_arm()
 planner.lock_head()
 planner.lock_grippers()
@@ -3,7 +3,13 @@
 # roslaunch prl_ur5_run real.launch velocity_control:=true ff_control:=true moveit:=false sensors:=true enable_right_camera:=false
 # roslaunch ros_cosypose singleview_loop.launch bringup_camera:=false dataset:=ycbv debug:=true camera_name:=left_camera/color detection_threshold:=0.85
 
-from copy import copy
+import queue
+import threading
+
+try:
+    from numba import njit # Optional, to compile the FT filter step
+except ImportError:
+    njit = None
 
 from prl_tsid.commander import PathFollower
 import numpy as np
@@ -11,7 +17,6 @@ import pinocchio as pin
 
 import rospy
 rospy.init_node("TSID_example", anonymous=True)
-rospy.loginfo("init_node")
 
 # Plan a trajectory using HPP
 from prl_hpp.ur5 import planner, robot, commander_left_arm, commander_right_arm
@@ -31,26 +36,36 @@ pf = PathFollower(robot)
 # pf.set_acceleration_limit(1)
 # pf.set_torque_limit(1)
 
-import tf
+LEFT_MEAS_FRAME_ID = robot.pin_robot_wrapper.model.getFrameId("left_measurment_joint")
+
 from geometry_msgs.msg import WrenchStamped, Twist
 from sensor_msgs.msg import Joy
 
-tf_listener = tf.TransformListener()
-
 # All this part is erroneous in most case #
 # Temporary fix until pin is released #
-def is_frame_supported(model, parent_frame_id, child_frame_id):
-    current_id = model.frames[child_frame_id].previousFrame
-    while model.frames[parent_frame_id].parent == model.frames[current_id].parent and  current_id > parent_frame_id:
-        current_id = model.frames[current_id].previousFrame
-    return model.frames[parent_frame_id].parent == model.frames[current_id].parent and current_id == parent_frame_id
+def compute_supported_frames(model):
+    '''For every frame, list the frames supported by it in the same body (i.e. whose chain of previous frames reaches it without changing of joint)'''
+    supported = {f_id: [] for f_id in range(len(model.frames))}
+    for f_id, frame in enumerate(model.frames):
+        current_id = frame.previousFrame
+        joint_id = model.frames[current_id].parent
+        while True:
+            supported[current_id].append(f_id)
+            previous_id = model.frames[current_id].previousFrame
+            if previous_id >= current_id or model.frames[previous_id].parent != joint_id:
+                break
+            current_id = previous_id
+    return supported
+
+# The model frames never change : the supported frames, inertias and placements are computed once, on first use (keyed by model and frame)
+SUPPORTED_FRAMES = {}
+SUPPORTED_INERTIA = {}
+FRAME_PLACEMENT = {}
 
 def compute_supported_frames_in_body(model, parent_frame_id):
-    res = []
-    for i,f in enumerate(model.frames[parent_frame_id:], start=parent_frame_id):
-        if(is_frame_supported(model, parent_frame_id, i)):
-            res.append(i)
-    return res
+    if id(model) not in SUPPORTED_FRAMES:
+        SUPPORTED_FRAMES[id(model)] = compute_supported_frames(model)
+    return SUPPORTED_FRAMES[id(model)][parent_frame_id]
 
 def compute_supported_inertia_in_body(model, frame_id):
     supported_frames = [frame_id] + compute_supported_frames_in_body(model,frame_id)
@@ -61,11 +76,17 @@ def compute_supported_inertia_in_body(model, frame_id):
     jMf = model.frames[frame_id].placement
     return jMf.actInv(j_inertia)
 
+def get_supported_inertia_and_placement(model, frame_id):
+    key = (id(model), frame_id)
+    if key not in SUPPORTED_INERTIA:
+        SUPPORTED_INERTIA[key] = compute_supported_inertia_in_body(model, frame_id)
+        FRAME_PLACEMENT[key] = model.frames[frame_id].placement
+    return SUPPORTED_INERTIA[key], FRAME_PLACEMENT[key]
+
 def compute_supported_effort(model, data, frame_id):
     joint_id = model.frames[frame_id].parent
-    iMf = model.frames[frame_id].placement
+    inertia, iMf = get_supported_inertia_and_placement(model, frame_id)
     oMf = data.oMi[joint_id] * iMf
-    inertia = compute_supported_inertia_in_body(model, frame_id)
     v_frame = pin.getFrameVelocity(model, data, frame_id, pin.ReferenceFrame.LOCAL)
     a_frame = pin.getFrameAcceleration(model, data, frame_id, pin.ReferenceFrame.LOCAL)
     effort = inertia.vxiv(v_frame) + inertia * (a_frame - oMf.actInv(model.gravity))
@@ -75,44 +96,112 @@ def compute_supported_effort(model, data, frame_id):
             continue
         effort += data.liMi[j_id].act(data.f[j_id])
     return iMf.actInv(effort)
+
+get_supported_inertia_and_placement(robot.pin_robot_wrapper.model, LEFT_MEAS_FRAME_ID) # Fill the caches of the measurement frame now, rather than in the first callback
 ###################################
 
 
-'''Transform the velocity e(expressed in the end effector frame) to the correct frame and set pf goal to it'''
-def set_ee_vel(v):
+LATEST_MEAS_ROT = None # Orientation of the measurement frame in world frame (updated by kinematics_update_cb), None if unknown
+KINEMATICS_DATA = robot.pin_robot_wrapper.model.createData() # Own data of kinematics_update_cb (robot.pin_robot_wrapper.data is also used by the FT worker and pf)
+'''Periodically update the orientation of the measurement frame, so that the callbacks don't have to compute the kinematics'''
+def kinematics_update_cb(event):
+    global LATEST_MEAS_ROT
     try:
         _, q, _, _ = robot.get_meas_qvtau()
     except:
-        rospy.logwarn("Joint out of bounds send 0 velocity.")
+        LATEST_MEAS_ROT = None
+        return
+    pin.framesForwardKinematics(robot.pin_robot_wrapper.model, KINEMATICS_DATA, q)
+    LATEST_MEAS_ROT = KINEMATICS_DATA.oMf[LEFT_MEAS_FRAME_ID].rotation.copy() # Single assignment : the callbacks always read a consistent rotation
+
+'''Transform the velocity e(expressed in the end effector frame) to the correct frame and set pf goal to it'''
+def set_ee_vel(v):
+    oMf_rotation = LATEST_MEAS_ROT
+    if oMf_rotation is None:
+        rospy.logwarn("Joint out of bounds (or end effector orientation not known yet) send 0 velocity.")
         pf.eeVelSample.derivative(np.zeros(6))
         return
-    vel_loc = pin.Motion(v)
-    frame_id = robot.pin_robot_wrapper.model.getFrameId("left_measurment_joint")
-    oMf = robot.pin_robot_wrapper.framePlacement(np.array(q), frame_id)
-    oMf_rot = pin.SE3(oMf.rotation, np.zeros(3))
-    vel_glob = oMf_rot.act(vel_loc)
-    pf.eeVelSample.derivative(vel_glob.vector)
+    vel_glob = (np.reshape(v, (2, 3)) @ oMf_rotation.T).ravel() # Pure rotation of the linear and angular parts
+    pf.eeVelSample.derivative(vel_glob)
 
 SUB_INERTIAL_FT = False # Should the inertial forces be taken out manually
+DEBUG_PUBLISH = False # Should the filtered force and the resulting velocity be published (on /left_ft_wrench_error and /vel_debug)
+FRIC = np.array([4, 0.4]) # "Friction" on the force : the first 4 N and 0.4 Nm won't be counted
 FILT_WIN = int(0.1 / 0.01) # filter window =  0.1s @ 100Hz
-filt_list = [pin.Force(np.zeros(6)) for _ in range(FILT_WIN)]
+FILT_BUF = np.zeros((FILT_WIN, 6)) # Ring buffer of the last (weighted) samples
+filt_sum = np.zeros(6) # Running sum of the ring buffer (i.e. filtered force)
 filt_i = 0
-filt_avg = pin.Force(np.zeros(6))
+RES_FRIC = np.empty(6) # Filtered force, with friction
+
+def _filt_step_numpy(buf, sum_, idx, sample, fric, res):
+    '''Add the sample to the ring buffer (in place, updating its running sum), and write in res the filtered force with friction. Return the next ring buffer index.'''
+    # Filtering the force signal (in place, in the ring buffer slot)
+    sum_ -= buf[idx]
+    np.divide(sample, buf.shape[0], out=buf[idx])
+    sum_ += buf[idx]
+    idx += 1
+    if idx == buf.shape[0]:
+        idx = 0
+
+    # Add "friction" to the measured force (norm of the translation and rotation parts reduced by their friction, down to 0)
+    force = sum_.reshape(2, 3)
+    force_norm = np.linalg.norm(force, axis=1)
+    fric_scale = np.maximum(1. - fric / np.maximum(force_norm, 1e-12), 0.)
+    np.multiply(force, fric_scale[:, None], out=res.reshape(2, 3))
+    return idx
+
+def _filt_step_loops(buf, sum_, idx, sample, fric, res):
+    '''Same as _filt_step_numpy, written with explicit loops to be compiled by numba'''
+    for k in range(6):
+        s = sample[k] / buf.shape[0]
+        sum_[k] += s - buf[idx, k]
+        buf[idx, k] = s
+    idx += 1
+    if idx == buf.shape[0]:
+        idx = 0
+
+    for p in range(2):
+        norm = np.sqrt(sum_[3*p]**2 + sum_[3*p+1]**2 + sum_[3*p+2]**2)
+        scale = max(1. - fric[p] / norm, 0.) if norm > 0. else 0.
+        for k in range(3*p, 3*p+3):
+            res[k] = sum_[k] * scale
+    return idx
+
+def _check_filt_steps(filt_step_a, filt_step_b, n_samples = 3 * FILT_WIN):
+    '''Check that both implementations of the filter step give the same result (on random wrenches, over a few filter windows)'''
+    samples = np.random.default_rng(0).uniform(-20, 20, (n_samples, 6))
+    states = [(np.zeros_like(FILT_BUF), np.zeros(6), 0, np.empty(6)) for _ in range(2)]
+    for sample in samples:
+        for k, filt_step_k in enumerate([filt_step_a, filt_step_b]):
+            buf, sum_, idx, res = states[k]
+            states[k] = (buf, sum_, filt_step_k(buf, sum_, idx, sample, FRIC, res), res)
+        assert states[0][2] == states[1][2] and np.allclose(states[0][3], states[1][3]), "The filter step implementations differ"
+
+# The vectorized numpy kernel is used by default, the loops one when it can be compiled by numba
+if njit is not None:
+    filt_step = njit(cache=True, fastmath=True)(_filt_step_loops)
+    _check_filt_steps(filt_step, _filt_step_numpy) # Also compiles it now, rather than in the first callback
+else:
+    filt_step = _filt_step_numpy
+    _check_filt_steps(filt_step, _filt_step_loops)
+
+FT_MAX_TRANS_VEL, FT_MAX_ROT_VEL = 0.1, 0.001 #np.pi/2
+FT_MAX_TRANS_FORCE, FT_MAX_ROT_FORCE = 10, 1
+FT_VEL_GAIN = np.array([FT_MAX_TRANS_VEL / FT_MAX_TRANS_FORCE]*3 + [FT_MAX_ROT_VEL / FT_MAX_ROT_FORCE]*3) # Velocity commanded per unit of force
+FT_VEL_LIMIT = np.array([FT_MAX_TRANS_VEL]*3 + [FT_MAX_ROT_VEL]*3)
+WRIST_VEC = np.empty(6) # Last wrench measured (re-used at each message)
+ANSWER_MSG = WrenchStamped() # Debug message (re-used at each message, rospy serializes it synchronously in publish)
 def control_from_fts_cb(msg):
-    global FILT_WIN, filt_list, filt_i, filt_avg
-    force_trans_fric = 4 # The first 4 N won't be counted
-    force_rot_fric = 0.4 # The first 0.2 Nm won't be counted
-    max_trans_vel = 0.1
-    max_rot_vel = 0.001 #np.pi/2
-    max_trans_force = 10
-    max_rot_force = 1
-
-    answer = WrenchStamped(header = msg.header)
-
-    wrist_f = pin.Force(np.array([msg.wrench.force.x, msg.wrench.force.y, msg.wrench.force.z, msg.wrench.torque.x, msg.wrench.torque.y, msg.wrench.torque.z]))
+    global filt_i
+    msg_force, msg_torque = msg.wrench.force, msg.wrench.torque
+    WRIST_VEC[0] = msg_force.x
+    WRIST_VEC[1] = msg_force.y
+    WRIST_VEC[2] = msg_force.z
+    WRIST_VEC[3] = msg_torque.x
+    WRIST_VEC[4] = msg_torque.y
+    WRIST_VEC[5] = msg_torque.z
 
     if(SUB_INERTIAL_FT):
-        frame_id = robot.pin_robot_wrapper.model.getFrameId("left_measurment_joint")
         try:
             t, q, v, tau = robot.get_meas_qvtau()
         except:
@@ -120,69 +209,85 @@ def control_from_fts_cb(msg):
             pf.eeVelSample.derivative(np.zeros(6))
             return
 
-        q, v, tau = np.array(q), np.array(v), np.array(tau)
+        q, v, tau = np.asarray(q), np.asarray(v), np.asarray(tau)
         robot.pin_robot_wrapper.forwardKinematics(q, v)
         pin.aba(robot.pin_robot_wrapper.model, robot.pin_robot_wrapper.data, q, v, tau)
         pin.crba(robot.pin_robot_wrapper.model, robot.pin_robot_wrapper.data, q)
-        effort = compute_supported_effort(robot.pin_robot_wrapper.model, robot.pin_robot_wrapper.data, frame_id)
-
-        wrist_f += effort # External effort taken out
-
-    # Filtering the force signal
-    filt_avg -= filt_list[filt_i]
-    filt_list[filt_i] = wrist_f / FILT_WIN
-    filt_avg += filt_list[filt_i]
-    filt_i = (filt_i + 1) % FILT_WIN
-
-    # Add "friction" to the measured force
-    force_trans = copy(filt_avg.vector[:3])
-    force_rot = copy(filt_avg.vector[3:])
-    if(np.linalg.norm(force_trans) < force_trans_fric):
-        force_trans = np.zeros(3)
-    else:
-        force_trans -= force_trans * force_trans_fric / np.linalg.norm(force_trans)
-    if(np.linalg.norm(force_rot) < force_rot_fric):
-        force_rot = np.zeros(3)
-    else:
-        force_rot -= force_rot * force_rot_fric / np.linalg.norm(force_rot)
-    res_fric = np.concatenate([force_trans, force_rot])
-
-    # # Publish the force for debug
-    # answer.wrench.force.x = res_fric[0]
-    # answer.wrench.force.y = res_fric[1]
-    # answer.wrench.force.z = res_fric[2]
-    # answer.wrench.torque.x = res_fric[3]
-    # answer.wrench.torque.y = res_fric[4]
-    # answer.wrench.torque.z = res_fric[5]
-    # force_debug_pub.publish(answer)
+        effort = compute_supported_effort(robot.pin_robot_wrapper.model, robot.pin_robot_wrapper.data, LEFT_MEAS_FRAME_ID)
+
+        WRIST_VEC += effort.vector # External effort taken out
+
+    # Filter the force signal and add "friction" to it
+    filt_i = filt_step(FILT_BUF, filt_sum, filt_i, WRIST_VEC, FRIC, RES_FRIC)
+    res_fric = RES_FRIC
+
+    # Publish the force for debug
+    if(DEBUG_PUBLISH):
+        ANSWER_MSG.header = msg.header
+        ANSWER_MSG.wrench.force.x = res_fric[0]
+        ANSWER_MSG.wrench.force.y = res_fric[1]
+        ANSWER_MSG.wrench.force.z = res_fric[2]
+        ANSWER_MSG.wrench.torque.x = res_fric[3]
+        ANSWER_MSG.wrench.torque.y = res_fric[4]
+        ANSWER_MSG.wrench.torque.z = res_fric[5]
+        force_debug_pub.publish(ANSWER_MSG)
 
     # Compute the vel from the force (with limits)
-    v = np.concatenate( [res_fric[:3] * max_trans_vel / max_trans_force, res_fric[3:] * max_rot_vel / max_rot_force] )
-    v_limit = np.array([max_trans_vel]*3 + [max_rot_vel]*3)
-    v = v.clip(-v_limit, v_limit)
-
-    # # Publish the vel for debug
-    # v_msg = Twist()
-    # v_msg.linear.x = v[0]
-    # v_msg.linear.y = v[1]
-    # v_msg.linear.z = v[2]
-    # v_msg.angular.x = v[3]
-    # v_msg.angular.y = v[4]
-    # v_msg.angular.z = v[5]
-    # vel_debug_pub.publish(v_msg)
+    v = (res_fric * FT_VEL_GAIN).clip(-FT_VEL_LIMIT, FT_VEL_LIMIT)
+
+    # Publish the vel for debug
+    if(DEBUG_PUBLISH):
+        v_msg = Twist()
+        v_msg.linear.x = v[0]
+        v_msg.linear.y = v[1]
+        v_msg.linear.z = v[2]
+        v_msg.angular.x = v[3]
+        v_msg.angular.y = v[4]
+        v_msg.angular.z = v[5]
+        vel_debug_pub.publish(v_msg)
 
     # Set the vel to the pf
     set_ee_vel(v)
 
+FTS_QUEUE = queue.Queue(maxsize=1) # Latest wrench received, waiting to be processed by fts_worker
+def enqueue_fts_cb(msg):
+    '''Only store the latest wrench, so that the subscriber thread is never blocked by the processing (done in fts_worker)'''
+    try:
+        FTS_QUEUE.get_nowait() # Drop the stale wrench if it hasn't been processed yet
+    except queue.Empty:
+        pass
+    FTS_QUEUE.put_nowait(msg)
+
+def fts_worker():
+    while not rospy.is_shutdown():
+        try:
+            msg = FTS_QUEUE.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        try:
+            control_from_fts_cb(msg)
+        except AssertionError as e: # e.g. joints out of bounds : keep processing the next wrenches, but don't keep the last velocity
+            rospy.logerr_throttle(1, "Error while processing the FT wrench: " + str(e) + ", send 0 velocity.")
+            pf.eeVelSample.derivative(np.zeros(6))
+        except:
+            pf.eeVelSample.derivative(np.zeros(6)) # Don't keep the last velocity once the FT processing stopped
+            raise
+
+ZERO_VEL = np.zeros(6)
+JOY_MAX_TRANS_VEL, JOY_MAX_ROT_VEL = 0.2, np.pi/2
+JOY_VEL_SCALE = np.array([JOY_MAX_TRANS_VEL]*3 + [0, 0, JOY_MAX_ROT_VEL])
 def control_from_joy_cb(msg):
-    max_trans_vel = 0.2
-    max_rot_vel = np.pi/2
-    vel_loc = pin.Motion(np.array([max_trans_vel*msg.axes[6], max_trans_vel*msg.axes[7], max_trans_vel*msg.axes[1], 0, 0, max_rot_vel*msg.axes[3]]))
+    # Joystick at rest (most messages) : the velocity is null in any frame, no need to compute the robot kinematics
+    if not (msg.axes[1] or msg.axes[3] or msg.axes[6] or msg.axes[7]):
+        pf.eeVelSample.derivative(ZERO_VEL)
+        return
+
+    vel_loc = JOY_VEL_SCALE * np.array([msg.axes[6], msg.axes[7], msg.axes[1], 0, 0, msg.axes[3]])
     set_ee_vel(vel_loc)
 
 if __name__=='__main__':
-    force_debug_pub = rospy.Publisher("/left_ft_wrench_error", WrenchStamped, queue_size=0)
-    vel_debug_pub = rospy.Publisher("/vel_debug", Twist, queue_size=0)
+    force_debug_pub = rospy.Publisher("/left_ft_wrench_error", WrenchStamped, queue_size=1, tcp_nodelay=True)
+    vel_debug_pub = rospy.Publisher("/vel_debug", Twist, queue_size=1, tcp_nodelay=True)
 
     # start_pose = [[-0.6, 0.0, 0.05], [np.pi, 0, np.pi]]
     # path = planner.make_gripper_approach(robot.left_gripper_name, start_pose, approach_distance = 0.01)
@@ -198,8 +303,10 @@ if __name__=='__main__':
     # robot.remove_collision_pair("table_link_0", "left_gripper_finger_2_flex_finger_0")
 
     input("Press enter to execute TSID motion...")
-    rospy.Subscriber("/joy", Joy, control_from_joy_cb)
-    rospy.Subscriber("/left_ft_wrench", WrenchStamped, control_from_fts_cb)
+    rospy.Timer(rospy.Duration(0.02), kinematics_update_cb) # 50Hz
+    rospy.Subscriber("/joy", Joy, control_from_joy_cb, queue_size=1, buff_size=2**16, tcp_nodelay=True)
+    threading.Thread(target=fts_worker, daemon=True).start()
+    rospy.Subscriber("/left_ft_wrench", WrenchStamped, enqueue_fts_cb, queue_size=1, buff_size=2**20, tcp_nodelay=True) # Only act on the latest wrench (drop stale ones)
     pf.follow_velocity("left_gripper_grasp_frame", [commander_left_arm], 0.1, velocity_ctrl = True)
 
     input("Press enter to quit...")
\ No newline at end of file
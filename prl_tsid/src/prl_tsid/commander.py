@@ -125,7 +125,7 @@ class PathFollower:
 
         # Initialize measures
         t, q_meas, v_meas, _ = self.robot.get_meas_qvtau(raw = True)
-        q_meas, v_meas = np.array(q_meas), np.array(v_meas)
+        q_meas, v_meas = np.asarray(q_meas), np.asarray(v_meas)
         v_next = np.zeros(self.tsid_robot.nv)
 
         # Loop
@@ -175,8 +175,8 @@ class PathFollower:
                 eeTasks[i].setReference(eeSamples[i])
 
             # Feedback
-            q_meas = np.array(q_meas)
-            v_meas = np.array(v_meas)
+            q_meas = np.asarray(q_meas)
+            v_meas = np.asarray(v_meas)
 
             # Because we control the robot on velocity, a velocity feedback would destabilised the control,
             # thus we supposed that the velocity is tracked perfectly
@@ -276,7 +276,7 @@ class PathFollower:
 
         # Initialize measures
         t, q_meas, v_meas, _ = self.robot.get_meas_qvtau(raw = True)
-        q_meas, v_meas= np.array(q_meas), np.array(v_meas)
+        q_meas, v_meas= np.asarray(q_meas), np.asarray(v_meas)
         v_next = np.zeros(self.tsid_robot.nv)
 
         # Set ee referece
@@ -305,8 +305,8 @@ class PathFollower:
             eeVelTask.setReference(self.eeVelSample)
 
             # Feedback
-            q_meas = np.array(q_meas)
-            v_meas = np.array(v_meas)
+            q_meas = np.asarray(q_meas)
+            v_meas = np.asarray(v_meas)
 
             # Because we control the robot on velocity, a velocity feedback would destabilised the control,
             # thus we supposed that the velocity is tracked perfectly